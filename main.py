@@ -5,11 +5,15 @@ import argparse
 from pathlib import Path
 from collections import namedtuple
 from collections.abc import Sequence
-from src.tokenize import Token, tokenize
+from src.tokenize import Token, TokenStream, tokenize
 
 from typing import NamedTuple, Callable
 
 
+# バリデータ命令の名前と引数 (引数はカンマ区切り)
+RE_VD_PARSE = re.compile(r'(\w+)\s+(.+)')
+
+
 class ValidateRule(NamedTuple):
     scope_level: int
     tag: str
@@ -23,49 +27,61 @@ def unused_message(token: Token) -> str:
 
 class ValidateError(NamedTuple):
     message: str
-    token: Token
+    index: int  # エラーとなったトークンの TokenStream 上の位置
 
 
-def validate_tokens(tokens: Sequence[Token]) -> list[ValidateError]:
+def validate_tokens(tokens: TokenStream) -> list[ValidateError]:
     errors = []
 
-    rules = []
+    # (tag, str) をキーとして、そのトークンに適用するルールを引けるようにしておく
+    rules: dict[tuple[str, str], list[ValidateRule]] = {}
+    # スコープごとに、そのスコープで定義されたルールのキーを積んでおく
+    rules_stack: list[list[tuple[str, str]]] = [[]]
     scope_level = 0
-    for token in tokens:
-        if token.str == '{':
+    for index, (tag, s) in enumerate(zip(tokens.tags, tokens.strs)):
+        if s == '{':
             scope_level += 1
+            rules_stack.append([])
 
-        elif token.str == '}':
+        elif s == '}':
             scope_level -= 1
-            # 現在のスコープと同じかより上位のスコープで定義されたルールのみ残す
-            rules = [r for r in rules if r.scope_level <= scope_level]
+            # 抜けたスコープで定義されたルールを取り除く
+            # (同じキーのルールは定義順に並んでいるので、逆順に末尾から取り除ける)
+            for key in reversed(rules_stack.pop()):
+                key_rules = rules[key]
+                key_rules.pop()
+                if not key_rules:
+                    del rules[key]
+            if not rules_stack:
+                rules_stack.append([])
+
+        elif tag == 'vd':
+            if not (m := RE_VD_PARSE.match(s)):
+                continue
+            name = m.group(1)
+            args = [arg.strip() for arg in m.group(2).split(',')]
 
-        elif token.tag == 'vd':
-            name, args = re.split(r'\s+', token.str, 1)
-            args = re.split(r'\s*,\s*', args)
-
-            rule = None
             if name == 'unused':
                 for arg in args:
-                    rule = ValidateRule(scope_level, 'id', arg, unused_message)
-
-            if rule:
-                rules.append(rule)
+                    rule = ValidateRule(scope_level, 'id', sys.intern(arg), unused_message)
+                    key = (rule.tag, rule.str)
+                    rules.setdefault(key, []).append(rule)
+                    rules_stack[-1].append(key)
 
-        else:
-            for rule in rules:
-                if token.tag == rule.tag and token.str == rule.str:
-                    error = ValidateError(rule.get_message(token), token)
-                    errors.append(error)
+        elif matched_rules := rules.get((tag, s)):
+            for rule in matched_rules:
+                error = ValidateError(rule.get_message(tokens[index]), index)
+                errors.append(error)
 
     return errors
 
 
-def print_validate_error(infile: str, code: str, errors: Sequence[ValidateError]):
-    lines = code.replace('\r\n', '\n').split('\n')
+def print_validate_error(infile: str, tokens: TokenStream, errors: Sequence[ValidateError]):
+    # tokens.code は改行を \n に統一済み
+    lines = tokens.code.split('\n')
     
     for error in errors:
-        token = error.token
+        token = tokens[error.index]
         prefix = f'{infile.name}:{token.lineno}:{token.columnno}: '
 
         print(f'{prefix}{error.message}')
@@ -89,7 +105,7 @@ def main():
     with open(str(infile)) as f:
         code = f.read()
 
-    tokens = tokenize(code)
+    tokens = tokenize(code, emit_pp=args.test_tokenize)
     if tokens is None:
         print('ERROR: tokenize was failed')
         return 1
@@ -100,7 +116,7 @@ def main():
 
     if errors := validate_tokens(tokens):
         print('ERROR: validate was failed')
-        print_validate_error(infile, code, errors)
+        print_validate_error(infile, tokens, errors)
         return 1
 
 
@@ -1,4 +1,7 @@
 import re
+from sys import intern
+from bisect import bisect_right
+from itertools import accumulate
 from typing import NamedTuple
 
 
@@ -38,97 +41,129 @@ class Token(NamedTuple):
         return repr(self)
 
 
-def tokenize(code: str) -> list[Token]:
-    code = code.replace('\r\n', '\n')
-
-    tokens = []
-    i = 0
-    lineno = 1
-    linestart = 0
-
-    def columnno():
-        return i - linestart + 1
-
-    while i < len(code):
-        subcode = code[i:]
-        token = None
-
-        # プリプロセッサ命令
-        if m := re.match(r'#[^\n]+', subcode):
-            token = Token('pp', m.group(), lineno, columnno())
-            i += len(m.group())
-
-        # バリデータ命令
-        elif m := re.match(r'//![^\n]+', subcode):
-            token = Token('vd', m.group()[3:], lineno, columnno())
-            i += len(m.group())
-
-        # コメント行
-        elif m := re.match(r'//[^\n]+', subcode):
-            i += len(m.group())
-
-        # ブロックコメント
-        elif m := re.match(r'/\*', subcode):
-            i += 2
-
-            while i < len(code):
-                subcode = code[i:]
-
-                if re.match(r'\*/', subcode):
-                    i += 2
-                    break
-                elif subcode[0] == '\n':
-                    i += 1
-                    lineno += 1
-                    linestart = i
-                else:
-                    i += 1
-
-        # 改行
-        elif subcode[0] == '\n':
-            i += 1
-            lineno += 1
-            linestart = i
-
-        # 空白
-        elif m := re.match(r'[ \t]+', subcode):
-            i += len(m.group())
-
-        # 識別子
-        elif m := re.match(r'[_a-zA-Z]\w*', subcode):
-            token = Token('id', m.group(), lineno, columnno())
-            i += len(m.group())
-
-        # 数値リテラル
-        elif m := re.match(r'\d+', subcode):
-            token = Token('num', m.group(), lineno, columnno())
-            i += len(m.group())
-
-        # 文字列リテラル
-        elif m := re.match(r'"(?:[^"]|\\.)*"', subcode):
-            token = Token('str', m.group(), lineno, columnno())
-            i += len(m.group())
-
-        # 記号 (3文字)
-        elif m := re.match(r'->\*|<<=|>>=', subcode):
-            token = Token('mark', m.group(), lineno, columnno())
-            i += len(m.group())
-
-        # 記号 (2文字)
-        elif m := re.match(r'->|\+\+|--|\.\*|<<|>>|[<>=!+\-*/%&^|]=|&&|\|\|', subcode):
-            token = Token('mark', m.group(), lineno, columnno())
-            i += len(m.group())
-
-        # 記号 (1文字)
-        elif m := re.match(r'[()[\]{}.,:?+\-*/%~&^|=!]', subcode):
-            token = Token('mark', m.group(), lineno, columnno())
-            i += len(m.group())
+class TokenStream:
+    """
+    トークン列を属性ごとのリストに分けて保持するクラス
+
+    i番目のトークンの各属性は tags[i], strs[i], offsets[i] に格納される
+    行位置・桁位置はエラー表示などで必要になったときに offset から求める
+
+    Attributes
+    ----------
+    code : str
+        トークン化したソースコード (改行は \n に統一済み)
+    tags : list[str]
+        トークンのタグ (Token.tag を参照)
+    strs : list[str]
+        トークンの文字列
+    offsets : list[int]
+        トークンのソースコード上の位置
+    """
+
+    __slots__ = ('code', 'tags', 'strs', 'offsets', '_line_starts')
+
+    def __init__(self, code: str):
+        self.code = code
+        self.tags = []
+        self.strs = []
+        self.offsets = []
+        self._line_starts = None
 
+    def position(self, offset: int) -> tuple[int, int]:
+        """ソースコード上の位置 offset を (行位置, 桁位置) に変換する"""
+        if self._line_starts is None:
+            # 各行の先頭位置 (初回のみ計算する)
+            self._line_starts = [0, *accumulate(len(line) + 1 for line in self.code.split('\n'))]
+
+        lineno = bisect_right(self._line_starts, offset)
+        return lineno, offset - self._line_starts[lineno - 1] + 1
+
+    def __len__(self):
+        return len(self.tags)
+
+    def __getitem__(self, index: int) -> Token:
+        return Token(self.tags[index], self.strs[index], *self.position(self.offsets[index]))
+
+    def __iter__(self):
+        return map(self.__getitem__, range(len(self)))
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+# トークンの正規表現
+# 先頭文字が重なるもの (/ で始まるコメントと記号など) は優先するものを先に並べる
+# どれにもマッチしない文字は err にマッチさせ、読み飛ばさずにエラーとする
+# 空白・改行はトークンの前にまとめて読み飛ばす (末尾の空白・改行は eof にマッチさせる)
+TOKEN_RE = re.compile(
+    r'[ \t\n]*(?:'
+    # 識別子
+    r'(?P<id>[_a-zA-Z]\w*)'
+    # プリプロセッサ命令
+    r'|(?P<pp>#[^\n]+)'
+    # バリデータ命令
+    r'|(?P<vd>//![^\n]+)'
+    # コメント行
+    r'|(?P<lc>//[^\n]+)'
+    # ブロックコメント (閉じられていなければ末尾まで)
+    r'|(?P<bc>/\*[\s\S]*?(?:\*/|\Z))'
+    # 記号 (長いものから順に)
+    r'|(?P<mark>->\*|<<=|>>='
+    r'|->|\+\+|--|\.\*|<<|>>|[<>=!+\-*/%&^|]=|&&|\|\|'
+    r'|[()[\]{}.,:?+\-*/%~&^|=!])'
+    # 数値リテラル
+    r'|(?P<num>\d+)'
+    # 文字列リテラル
+    r'|(?P<str>"(?:[^"\\]|\\.)*")'
+    # 未知の文字
+    r'|(?P<err>.)'
+    # 末尾
+    r'|(?P<eof>\Z))'
+)
+
+
+# トークンとして出力しないグループ (コメント・末尾)
+SKIP_KINDS = frozenset(('lc', 'bc', 'eof'))
+# プリプロセッサ命令はバリデーションでは参照しないため、通常は出力しない
+SKIP_KINDS_WITH_PP = SKIP_KINDS | {'pp'}
+
+
+def tokenize(code: str, emit_pp: bool = False) -> TokenStream:
+    # NOTE: bytes には変換せず str のまま走査する
+    #       ASCII のみの str は内部的に1文字1バイトで保持されるため、
+    #       bytes にしても速くならず、トークンごとの decode の分だけ遅くなる
+    # \r を含まない (改行が \n のみの) ソースではコピーを作らずに済ませる
+    if '\r' in code:
+        code = code.replace('\r\n', '\n')
+
+    tokens = TokenStream(code)
+    tags = tokens.tags
+    strs = tokens.strs
+    offsets = tokens.offsets
+
+    skip_kinds = SKIP_KINDS if emit_pp else SKIP_KINDS_WITH_PP
+
+    for m in TOKEN_RE.finditer(code):
+        kind = m.lastgroup
+
+        if kind in skip_kinds:
+            continue
+
+        # 先頭の空白・改行を除いたトークン部分のグループ
+        group = m.lastindex
+
+        if kind == 'id':
+            s = intern(m.group(group))
+        elif kind == 'vd':
+            s = m.group(group)[3:]
+        elif kind == 'err':
+            lineno, columnno = tokens.position(m.start(group))
+            raise Exception(f"Unknown character '{m.group(group)}' at {lineno}:{columnno}")
         else:
-            raise Exception(f"Unknown character '{subcode[0]}' at {lineno}:{columnno()}")
+            s = m.group(group)
 
-        if token:
-            tokens.append(token)
+        tags.append(kind)
+        strs.append(s)
+        offsets.append(m.start(group))
 
     return tokens
-